@@ -5,28 +5,127 @@ import sys
 import subprocess
 import signal
 import struct
-import select
+import selectors
 import time
 import json
+import queue
+import threading
 import atexit
 import errno
 import re
 import fcntl
 import termios
-
-# I/O バッファサイズ定数（vim などの対話的アプリに優しいサイズに調整）
-IO_BUFFER_SIZE = 1024
+from collections import defaultdict, deque
+
+# リサイズのたびに termios モジュールの属性を引かないよう定数として保持
+TIOCSWINSZ = termios.TIOCSWINSZ
+# struct winsize (ws_row, ws_col, ws_xpixel, ws_ypixel) のフォーマットは事前にコンパイルしておく
+WINSIZE_STRUCT = struct.Struct('HHHH')
+# フロントエンドへのステータスメッセージを包む OSC 777 シーケンスの前後
+STATUS_SEQUENCE_PREFIX = b'\x1b]777;'
+STATUS_SEQUENCE_SUFFIX = b'\x07'
+# ステータスメッセージ用の JSON エンコーダー（区切りの空白を省き、生成は1回だけにする）
+encode_status_json = json.JSONEncoder(separators=(',', ':'), ensure_ascii=False).encode
+
+# I/O バッファサイズ定数（1回の os.read で読み取る最大バイト数）
+IO_BUFFER_SIZE = 65536
+# stdin（Node.js からの入力）を1回の os.read で読み取る最大バイト数
+# （PTY に書ききれない分は input_backlog に溜めるので、大きくしてもループは止まらない）
+INPUT_BUFFER_SIZE = 65536
+# PTY 出力を1回の待機でまとめて読み取る上限（大量出力中も stdin の処理が滞らないようにする）
+PTY_DRAIN_LIMIT = IO_BUFFER_SIZE * 4
+# PTY 出力をまとめて送る最大の待ち時間（秒）と、待たずに送る溜まり量（バイト）
+OUTPUT_FLUSH_INTERVAL = 0.012
+OUTPUT_FLUSH_THRESHOLD = 65536
+# Python のバッファ層を経由せず直接書き込むための stdout の fd
+STDOUT_FD = sys.stdout.fileno()
+# WebView からのリサイズ通知シーケンス: ESC [ 8 ; rows ; cols t
+RESIZE_RE = re.compile(rb'\x1b\[8;(\d+);(\d+)t')
+# 入力末尾で途切れたリサイズシーケンス（の先頭部分）
+RESIZE_PREFIX_RE = re.compile(rb'\x1b(?:\[(?:8(?:;\d*(?:;\d*)?)?)?)?\Z')
+# CLI エージェント名のいずれかを含むかの事前判定用
+CLI_AGENT_NAME_RE = re.compile(rb'claude|gemini|codex|copilot', re.IGNORECASE)
+# CLI エージェント検出の間隔（秒）
+CLI_AGENT_CHECK_INTERVAL = 3.0
+# CLI エージェント検出結果を再利用する期間（秒）
+CLI_AGENT_CACHE_TTL = 2.5
+# フォアグラウンドプロセス名チェックの間隔（秒）
+FG_PROCESS_CHECK_INTERVAL = 1.0
+# /proc が使える環境（Linux）では ps を起動せずにプロセス情報を読む
+USE_PROCFS = os.path.exists('/proc/self/stat')
+# /proc/<pid>/task/<tid>/children は CONFIG_PROC_CHILDREN が有効なカーネルでのみ存在する
+USE_PROC_CHILDREN = os.path.exists(f'/proc/self/task/{os.getpid()}/children')
+
+# 直近の CLI エージェント検出結果（fingerprint はシェルの直接の子 PID のタプル）
+cli_agent_cache = {
+    'shell_pid': None,
+    'fingerprint': None,
+    'result': None,
+    'checked_at': 0.0,
+}
 
 
 def set_winsize(fd, rows, cols):
     """ターミナルサイズを設定"""
     try:
-        winsize = struct.pack('HHHH', rows, cols, 0, 0)
-        fcntl.ioctl(fd, termios.TIOCSWINSZ, winsize)
-    except OSError:
+        fcntl.ioctl(fd, TIOCSWINSZ, WINSIZE_STRUCT.pack(rows, cols, 0, 0))
+    except (OSError, struct.error):
         pass
 
 
+def write_all(fd, data):
+    """fd にデータを全て書き込む（短い書き込みが起きた場合は残りを書き直す）"""
+    view = memoryview(data)
+    while view:
+        n = os.write(fd, view)
+        view = view[n:]
+
+
+def utf8_complete_length(data):
+    """data の末尾で途切れている UTF-8 マルチバイト文字を除いた長さを返す"""
+    n = len(data)
+    # 末尾から最大3バイト遡って、マルチバイト文字の先頭バイトを探す
+    for i in range(1, min(n, 3) + 1):
+        byte = data[n - i]
+        if byte & 0xC0 == 0x80:
+            # 継続バイトなのでさらに遡る
+            continue
+        if byte >= 0xF0:
+            needed = 4
+        elif byte >= 0xE0:
+            needed = 3
+        elif byte >= 0xC0:
+            needed = 2
+        else:
+            needed = 1
+        return n - i if i < needed else n
+    return n
+
+
+def create_selector():
+    """I/O 多重化用のセレクターを作成する。
+
+    Linux では epoll を使い、fd の登録をループの外で一度だけ行うことで
+    毎回の fd 集合の構築とカーネルへの再登録を避ける。
+    epoll が無い環境（macOS など）では従来通り select() を使う。
+    """
+    if hasattr(selectors, 'EpollSelector'):
+        return selectors.EpollSelector()
+    return selectors.SelectSelector()
+
+
+def open_pidfd(pid):
+    """プロセス終了を fd の読み取り可能イベントとして待つための pidfd を開く。
+
+    Linux 5.3+ / Python 3.9+ でのみ利用可能。使えない環境では None を返し、
+    呼び出し側は従来通り poll() による終了確認にフォールバックする。
+    """
+    try:
+        return os.pidfd_open(pid)
+    except (AttributeError, OSError):
+        return None
+
+
 def get_foreground_process_name(shell_pid):
     """シェルプロセスのフォアグラウンド子プロセス名を取得する。
 
@@ -88,140 +187,268 @@ def get_foreground_process_name(shell_pid):
         return None
 
 
+def build_process_tree_from_procfs():
+    """/proc/<pid>/stat を直接読み、親 PID -> 子 PID リストの対応表を作る。"""
+    children = defaultdict(list)
+    for name in os.listdir('/proc'):
+        if not name.isdigit():
+            continue
+        try:
+            with open(f'/proc/{name}/stat', 'rb') as f:
+                stat = f.read()
+        except OSError:
+            # 列挙後に終了したプロセスなどは無視
+            continue
+        # comm は括弧で囲まれ、空白や括弧を含み得るため最後の ')' 以降を分割する
+        # (state, ppid, ...) の順に並ぶ
+        fields = stat.rpartition(b')')[2].split()
+        try:
+            children[int(fields[1])].append(int(name))
+        except (IndexError, ValueError):
+            continue
+    return children
+
+
+def build_process_tree():
+    """全プロセスの親 PID -> 子 PID リストの対応表を作る。
+
+    /proc/<pid>/task/<tid>/children を使えない環境向け。
+    Linux では /proc を直接読み、ps の起動（fork/exec とパイプ）自体を省く。
+    それ以外の環境（macOS など）では1回の ps 呼び出しで作り、args を含めないことで
+    プロセス数が多い環境でも出力を小さく保つ。
+    """
+    if USE_PROCFS:
+        return build_process_tree_from_procfs()
+
+    children = defaultdict(list)
+    try:
+        r = subprocess.run(
+            ['ps', '-Ao', 'pid=,ppid='],
+            capture_output=True,
+            text=True,
+            timeout=1,
+            encoding='utf-8',
+            errors='ignore',
+        )
+    except (subprocess.TimeoutExpired, subprocess.SubprocessError, OSError):
+        return children
+    if r.returncode != 0:
+        return children
+    for line in r.stdout.splitlines():
+        parts = line.split()
+        if len(parts) != 2:
+            continue
+        try:
+            pid, ppid = int(parts[0]), int(parts[1])
+        except ValueError:
+            continue
+        children[ppid].append(pid)
+    return children
+
+
+def read_process_comm(pid):
+    """/proc からコマンド名（ps の comm= 相当）を bytes のまま読み取る。読み取れなければ None"""
+    try:
+        with open(f'/proc/{pid}/comm', 'rb') as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+def read_process_args(pid):
+    """/proc から引数（ps の args= 相当）を bytes のまま読み取る。読み取れなければ空"""
+    try:
+        with open(f'/proc/{pid}/cmdline', 'rb') as f:
+            cmdline = f.read()
+    except OSError:
+        return b''
+    # cmdline は NUL 区切りなので、ps の args と同じく空白区切りにする
+    return cmdline.rstrip(b'\0').replace(b'\0', b' ')
+
+
+def detect_cli_agent(comm, args):
+    """コマンド名と引数（bytes）から CLI エージェントの種別を判定する。該当しなければ None
+
+    大半のプロセスはエージェント名を含まないので、まず大文字小文字を無視した
+    正規表現で絞り込み、含む場合だけ小文字化して個別の判定を行う。
+    """
+    if not (CLI_AGENT_NAME_RE.search(comm) or CLI_AGENT_NAME_RE.search(args)):
+        return None
+    comm = comm.lower()
+    args = args.lower()
+    # Claude 検出
+    if b'claude' in comm or b' claude ' in args:
+        return 'claude'
+    # Gemini 検出
+    if b'/bin/gemini' in args or b' gemini ' in args or comm == b'gemini':
+        return 'gemini'
+    # Codex 検出
+    if b'codex' in comm or b' codex ' in args or b'/bin/codex' in args:
+        return 'codex'
+    # Copilot 検出
+    if b'copilot' in comm or b' copilot ' in args or b'/bin/copilot' in args:
+        return 'copilot'
+    return None
+
+
+def detect_cli_agent_from_comm(comm):
+    """コマンド名だけで CLI エージェントの種別が確定する場合に返す。確定しなければ None
+
+    detect_cli_agent() は先頭の規則から順に判定するため、引数を見ずに確定できるのは
+    最初に判定する Claude に一致した場合に限られる（他の種別は引数次第で Claude になり得る）。
+    """
+    agent_type = detect_cli_agent(comm, b'')
+    return agent_type if agent_type == 'claude' else None
+
+
+def list_child_pids(pid):
+    """プロセスの直接の子 PID をソート済みのタプルで返す。
+
+    /proc/<pid>/task/<tid>/children が使えればそれを読み、それ以外は pgrep -P を使う。
+    """
+    if USE_PROC_CHILDREN:
+        try:
+            tids = os.listdir(f'/proc/{pid}/task')
+        except OSError:
+            # プロセス自体が終了している
+            return ()
+        pids = []
+        for tid in tids:
+            try:
+                with open(f'/proc/{pid}/task/{tid}/children', 'rb') as f:
+                    pids.extend(int(x) for x in f.read().split())
+            except (OSError, ValueError):
+                # 列挙後に終了したスレッドは無視し、残りのスレッドの子は使う
+                continue
+        return tuple(sorted(pids))
+
+    try:
+        r = subprocess.run(
+            ['pgrep', '-P', str(pid)],
+            capture_output=True,
+            timeout=1,
+        )
+    except (subprocess.TimeoutExpired, subprocess.SubprocessError, OSError):
+        return ()
+    try:
+        return tuple(sorted(int(x) for x in r.stdout.split()))
+    except ValueError:
+        return ()
+
+
 def check_cli_agent_active(shell_pid):
+    """CLI エージェントの稼働有無を、短時間のキャッシュ付きで判定する。
+
+    直近 CLI_AGENT_CACHE_TTL 秒以内に判定済みで、シェルの直接の子プロセス構成が
+    変わっていなければ、子孫全体の探索を省いて前回の結果を返す。
+    NULL による強制チェックが定期チェックの直後に来た場合などに効く。
+    """
+    cache = cli_agent_cache
+    now = time.monotonic()
+    fingerprint = list_child_pids(shell_pid)
+    if (
+        cache['shell_pid'] == shell_pid
+        and now - cache['checked_at'] < CLI_AGENT_CACHE_TTL
+        and fingerprint == cache['fingerprint']
+    ):
+        return cache['result']
+
+    if not fingerprint:
+        # 子プロセスが無い（プロンプト待ちの）シェルでは子孫の探索自体を省く
+        result = {'active': False, 'agent_type': None}
+    elif USE_PROC_CHILDREN:
+        # Linux では子孫だけを /proc/<pid>/task/<tid>/children から辿る
+        # （シェル自身の子は fingerprint として読んだ結果を使い回す）
+        result = find_cli_agent(
+            shell_pid,
+            lambda pid: fingerprint if pid == shell_pid else list_child_pids(pid),
+        )
+    else:
+        children = build_process_tree()
+        result = find_cli_agent(shell_pid, lambda pid: children.get(pid, ()))
+    cache['shell_pid'] = shell_pid
+    cache['fingerprint'] = fingerprint
+    cache['result'] = result
+    cache['checked_at'] = now
+    return result
+
+
+def find_cli_agent(shell_pid, get_children):
     """シェルプロセス配下で CLI エージェント（Claude, Gemini, Codex, Copilot）の稼働有無を軽量に判定する。
 
     以前は `ps -eo pid,ppid,comm,args` で全プロセスを列挙していたが、
     環境によっては出力が大きくなり、3秒ごとの実行でも徐々に CPU 使用率が上がる可能性があった。
-    ここでは pgrep を用いた親子探索(BFS)と、対象 PID 群に限定した ps 呼び出しにより負荷を抑える。
+    その後の `pgrep -P` による親子探索は、子孫のノードごとにプロセスを起動していた。
+    ここでは BFS で子孫を求めたうえで、対象 PID 群に限定して詳細を調べることで負荷を抑える。
+    get_children には PID を受け取り直接の子 PID 群を返す関数を渡す
+    （Linux は /proc の children ファイル、それ以外は `ps -Ao pid=,ppid=` で作った対応表）。
     """
     try:
         # BFS で深さ5までの子孫 PID を列挙
-        def list_children(parent_pid):
-            try:
-                r = subprocess.run(
-                    ['pgrep', '-P', str(parent_pid)],
-                    capture_output=True,
-                    text=True,
-                    timeout=1,
-                    encoding='utf-8',
-                    errors='ignore',
-                )
-                if r.returncode not in (0, 1):
-                    return []
-                lines = r.stdout.strip().split('\n') if r.stdout else []
-                result = []
-                for line in lines:
-                    line = line.strip()
-                    if not line:
-                        continue
-                    try:
-                        result.append(int(line))
-                    except ValueError:
-                        pass
-                return result
-            except (
-                subprocess.TimeoutExpired,
-                subprocess.SubprocessError,
-                FileNotFoundError,
-            ):
-                return []
-
         max_depth = 5
         descendants = []
-        queue = [(shell_pid, 0)]
+        pending = deque([(shell_pid, 0)])
         seen = {shell_pid}
 
-        while queue:
-            pid, depth = queue.pop(0)
+        while pending:
+            pid, depth = pending.popleft()
             if depth >= max_depth:
                 continue
-            for c in list_children(pid):
+            for c in get_children(pid):
                 if c in seen:
                     continue
                 seen.add(c)
+                if USE_PROCFS:
+                    # /proc から見つけた順に調べ、該当すれば即座に返す
+                    comm = read_process_comm(c)
+                    if comm is not None:
+                        # comm だけで種別が確定する場合は cmdline を読まない
+                        agent_type = detect_cli_agent_from_comm(comm)
+                        if agent_type is None:
+                            agent_type = detect_cli_agent(comm, read_process_args(c))
+                        if agent_type:
+                            return {'active': True, 'agent_type': agent_type}
                 descendants.append(c)
-                queue.append((c, depth + 1))
+                pending.append((c, depth + 1))
 
-        if not descendants:
+        if not descendants or USE_PROCFS:
             return {'active': False, 'agent_type': None}
 
-        # 収集した子孫 PID だけを対象に、最小限の ps で詳細を取得
-        # macOS の ps は複数 PID をカンマ区切りで受け付ける
-        def batched(iterable, size):
-            it = iter(iterable)
-            while True:
-                chunk = []
-                try:
-                    for _ in range(size):
-                        chunk.append(next(it))
-                except StopIteration:
-                    if chunk:
-                        yield chunk
-                    break
-                yield chunk
-
-        for chunk in batched(descendants, 50):
+        # 収集した子孫 PID だけを対象に、1回の ps で詳細を取得
+        # macOS の ps は複数 PID をカンマ区切りで受け付ける（ARG_MAX までは1回で渡せる）
+        try:
+            r = subprocess.run(
+                [
+                    'ps',
+                    '-o',
+                    'comm=,args=',
+                    '-p',
+                    ','.join(str(x) for x in descendants),
+                ],
+                capture_output=True,
+                timeout=1,
+            )
+        except (
+            subprocess.TimeoutExpired,
+            subprocess.SubprocessError,
+            FileNotFoundError,
+        ):
+            return {'active': False, 'agent_type': None}
+        for line in r.stdout.splitlines():
+            if not line.strip():
+                continue
+            # comm と args はスペース区切りだが、args はスペースを含む。
+            # 'comm=,args=' により先頭フィールドはコマンド名のみ、それ以降を args として扱える。
             try:
-                r = subprocess.run(
-                    [
-                        'ps',
-                        '-o',
-                        'comm=,args=',
-                        '-p',
-                        ','.join(str(x) for x in chunk),
-                    ],
-                    capture_output=True,
-                    text=True,
-                    timeout=1,
-                    encoding='utf-8',
-                    errors='ignore',
-                )
-                if r.returncode != 0:
-                    continue
-                for line in r.stdout.splitlines():
-                    if not line.strip():
-                        continue
-                    # comm と args はスペース区切りだが、args はスペースを含む。
-                    # 'comm=,args=' により先頭フィールドはコマンド名のみ、それ以降を args として扱える。
-                    try:
-                        # 先頭のコマンド名と残りを args として分離
-                        parts = line.strip().split(None, 1)
-                        comm = parts[0].lower() if parts else ''
-                        args = parts[1].lower() if len(parts) > 1 else ''
-
-                        # Claude 検出
-                        if 'claude' in comm or ' claude ' in args:
-                            return {'active': True, 'agent_type': 'claude'}
-                        # Gemini 検出
-                        if (
-                            '/bin/gemini' in args
-                            or ' gemini ' in args
-                            or comm == 'gemini'
-                        ):
-                            return {'active': True, 'agent_type': 'gemini'}
-                        # Codex 検出
-                        if (
-                            'codex' in comm
-                            or ' codex ' in args
-                            or '/bin/codex' in args
-                        ):
-                            return {'active': True, 'agent_type': 'codex'}
-                        # Copilot 検出
-                        if (
-                            'copilot' in comm
-                            or ' copilot ' in args
-                            or '/bin/copilot' in args
-                        ):
-                            return {'active': True, 'agent_type': 'copilot'}
-                    except Exception:
-                        # 行のパース失敗は無視して続行
-                        continue
-            except (
-                subprocess.TimeoutExpired,
-                subprocess.SubprocessError,
-                FileNotFoundError,
-            ):
+                # 先頭のコマンド名と残りを args として分離
+                parts = line.strip().split(None, 1)
+                comm = parts[0] if parts else b''
+                args = parts[1] if len(parts) > 1 else b''
+                agent_type = detect_cli_agent(comm, args)
+                if agent_type:
+                    return {'active': True, 'agent_type': agent_type}
+            except Exception:
+                # 行のパース失敗は無視して続行
                 continue
 
         return {'active': False, 'agent_type': None}
@@ -232,16 +459,73 @@ def check_cli_agent_active(shell_pid):
 
 
 
+def monitor_shell_processes(shell_pid, status_queue, wake_fd, force_check, stop):
+    """シェル配下のプロセスを定期的に調べるバックグラウンドスレッドの本体。
+
+    CLI エージェントの検出やフォアグラウンドプロセス名の取得は ps などの
+    プロセス起動を伴い得るため、メイン I/O ループで行うと PTY 出力の転送が止まる。
+    状態が変化したらエンコード済みのステータスメッセージを status_queue に積み、wake_fd に
+    1バイト書き込んでメイン I/O ループを起こす（stdout への書き込みはメインスレッドだけが行う）。
+    force_check がセットされた場合は、間隔を待たずに CLI エージェントを検出して通知する。
+    """
+    current_agent_state = {'active': False, 'agent_type': None}
+    current_fg_process = None
+    # 起動直後のシェルには子プロセスがないので、最初の CLI エージェントチェックは1間隔後に行う
+    # （強制チェックは待たずに行う）。同じ PID の以前のシェルの判定結果は使わない。
+    next_agent_check = time.monotonic() + CLI_AGENT_CHECK_INTERVAL
+    next_fg_process_check = 0.0
+    cli_agent_cache['shell_pid'] = None
+
+    def publish(message_type, data):
+        # JSON のエンコードもこのスレッドで済ませ、メイン I/O ループは書き込むだけにする
+        status_queue.put(encode_status_message(message_type, data))
+        if stop.is_set():
+            return
+        try:
+            os.write(wake_fd, b'\0')
+        except OSError:
+            # パイプが満杯なら既に起床待ちの通知がある
+            pass
+
+    while not stop.is_set():
+        now = time.monotonic()
+        forced = force_check.is_set()
+        if forced:
+            force_check.clear()
+
+        # CLI エージェントアクティブチェック（強制チェック時は変化がなくても通知）
+        if forced or now >= next_agent_check:
+            new_agent_state = check_cli_agent_active(shell_pid)
+            if forced or new_agent_state != current_agent_state:
+                current_agent_state = new_agent_state
+                publish('cli_agent_status', current_agent_state)
+            next_agent_check = now + CLI_AGENT_CHECK_INTERVAL
+
+        # フォアグラウンドプロセス名チェック
+        if now >= next_fg_process_check:
+            new_fg_process = get_foreground_process_name(shell_pid)
+            if new_fg_process and new_fg_process != current_fg_process:
+                current_fg_process = new_fg_process
+                publish('foreground_process', {'name': current_fg_process})
+            next_fg_process_check = now + FG_PROCESS_CHECK_INTERVAL
+
+        timeout = min(next_agent_check, next_fg_process_check) - time.monotonic()
+        force_check.wait(max(timeout, 0.0))
+
+
+def encode_status_message(message_type, data):
+    """ステータスメッセージを stdout にそのまま書ける bytes にエンコードする"""
+    message = {"type": message_type, "data": data}
+    # JSON メッセージを特別なエスケープシーケンスで送信
+    message_json = encode_status_json(message).encode('utf-8')
+    # CSI シーケンスを使用してカスタムメッセージを送信
+    return STATUS_SEQUENCE_PREFIX + message_json + STATUS_SEQUENCE_SUFFIX
+
+
 def send_status_message(message_type, data):
     """ステータスメッセージをフロントエンドに送信"""
     try:
-        message = {"type": message_type, "data": data}
-        # JSON メッセージを特別なエスケープシーケンスで送信
-        message_json = json.dumps(message)
-        # CSI シーケンスを使用してカスタムメッセージを送信
-        status_sequence = f'\x1b]777;{message_json}\x07'
-        sys.stdout.buffer.write(status_sequence.encode('utf-8'))
-        sys.stdout.buffer.flush()
+        write_all(STDOUT_FD, encode_status_message(message_type, data))
     except Exception:
         pass
 
@@ -277,6 +561,15 @@ def main():
             log(f"Warning: Failed to parse startup commands: {e}")
             startup_commands = []
 
+    # 空でないコマンドを改行区切りでまとめ、起動後に1回の書き込みで PTY に送る
+    # （シェルは入力を順に読むので、コマンド間に待ち時間を挟む必要はない）
+    startup_commands = [cmd for cmd in startup_commands if cmd.strip()]
+    startup_payload = b''
+    if startup_commands:
+        startup_payload = ('\n'.join(startup_commands) + '\n').encode(
+            'utf-8', errors='replace'
+        )
+
     # グローバル変数でプロセス参照を保持
     global current_shell_process, current_master
     current_shell_process = None
@@ -331,11 +624,14 @@ def main():
         os.setsid()
 
     while True:  # シェルプロセスが終了したら再起動するループ
-        # 環境変数を設定
-        os.environ['TERM'] = 'xterm-256color'
-        os.environ['COLUMNS'] = str(initial_cols)
-        os.environ['LINES'] = str(initial_rows)
-        os.environ['TERM_PROGRAM'] = 'secondary-terminal'
+        # シェルに渡す環境変数（自プロセスの os.environ は書き換えない）
+        child_env = {
+            **os.environ,
+            'TERM': 'xterm-256color',
+            'COLUMNS': str(initial_cols),
+            'LINES': str(initial_rows),
+            'TERM_PROGRAM': 'secondary-terminal',
+        }
 
         # PTY を作成
         master, slave = pty.openpty()
@@ -356,6 +652,7 @@ def main():
                 stderr=slave,
                 preexec_fn=setup_child_process,
                 cwd=cwd,
+                env=child_env,
             )
             current_shell_process = p  # グローバル変数に保存
         except Exception as e:
@@ -373,314 +670,350 @@ def main():
                 stderr=slave,
                 preexec_fn=setup_child_process,
                 cwd=cwd,
+                env=child_env,
             )
             current_shell_process = p  # グローバル変数に保存
 
         os.close(slave)
 
-        # 非ブロッキング I/O を設定
+        # 非ブロッキング I/O を設定（PTY マスターと標準入力）
         try:
-            import fcntl
-
-            # PTY マスターを非ブロッキングに設定
-            flags = fcntl.fcntl(master, fcntl.F_GETFL)
-            fcntl.fcntl(master, fcntl.F_SETFL, flags | os.O_NONBLOCK)
-
-            # 標準入力も非ブロッキングに設定
-            stdin_flags = fcntl.fcntl(sys.stdin.fileno(), fcntl.F_GETFL)
-            fcntl.fcntl(
-                sys.stdin.fileno(), fcntl.F_SETFL, stdin_flags | os.O_NONBLOCK
-            )
-        except (ImportError, OSError):
-            log("fcntl: Warning: Failed to set non-blocking I/O")
-            pass
+            os.set_blocking(master, False)
+            os.set_blocking(sys.stdin.fileno(), False)
+        except OSError:
+            log("Warning: Failed to set non-blocking I/O")
+
+        # 監視対象の fd を一度だけ登録しておく
+        stdin_fd = sys.stdin.fileno()
+        selector = create_selector()
+        selector.register(master, selectors.EVENT_READ)
+        selector.register(stdin_fd, selectors.EVENT_READ)
+        # シェルの終了も同じセレクターで待つ（pidfd が使えれば poll() の定期確認が不要）
+        pidfd = open_pidfd(p.pid)
+        if pidfd is not None:
+            selector.register(pidfd, selectors.EVENT_READ)
+
+        # CLI エージェント・フォアグラウンドプロセスの監視はバックグラウンドスレッドで行い、
+        # 変化があれば wake パイプ経由でメイン I/O ループを起こしてステータスを送信する
+        status_queue = queue.SimpleQueue()
+        wake_r, wake_w = os.pipe()
+        os.set_blocking(wake_r, False)
+        os.set_blocking(wake_w, False)
+        selector.register(wake_r, selectors.EVENT_READ)
+        force_agent_check = threading.Event()
+        stop_monitor = threading.Event()
+        monitor_thread = threading.Thread(
+            target=monitor_shell_processes,
+            args=(p.pid, status_queue, wake_w, force_agent_check, stop_monitor),
+            daemon=True,
+        )
+        monitor_thread.start()
 
-        # CLI エージェント監視のための変数
-        last_agent_check = 0
+        # pidfd が使えない環境（macOS など）では、SIGCHLD で wake パイプに書き込ませて
+        # シェルの終了時にも selector を起こす（poll() 確認のための定期的な起床を省く）
+        sigchld_wakeup = False
+        if pidfd is None:
+            try:
+                signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+                signal.set_wakeup_fd(wake_w, warn_on_full_buffer=False)
+                sigchld_wakeup = True
+            except (ValueError, OSError):
+                pass
         # NULL での強制チェックにレート制限を導入（過剰な発火での高負荷を防止）
-        last_forced_check = 0.0
+        next_forced_check = 0.0
         forced_check_cooldown = 1.5  # 秒
-        current_agent_state = {'active': False, 'agent_type': None}
-        check_interval = 3.0  # 3秒間隔に変更
 
-        # フォアグラウンドプロセス監視のための変数
-        last_fg_process_check = 0
-        fg_process_check_interval = 1.0  # 1秒間隔
-        current_fg_process = None
-
-        # UTF-8 デコード用のバッファ（マルチバイト文字の分割対応）
-        input_buffer = b''
-        # stdin が EOF/クローズされたかどうかのフラグ（EOF 後は select 対象から外してスピンを防ぐ）
-        stdin_open = True
+        # 読み取り境界で途切れたリサイズシーケンスの先頭部分
+        pending_input = b''
+
+        # PTY 出力の送信待ちバッファ（短い間隔で届く出力をまとめて1回で送る）
+        output_buffer = bytearray()
+        output_deadline = None
+        # 入力を PTY に書いた直後の出力（エコー）は待たずに送る
+        echo_pending = False
+
+        # PTY に書ききれなかった入力（大量のペーストなど）。溜まっている間は stdin の
+        # 読み取りを止め、PTY が書き込み可能になるたびに送る（メイン I/O ループは止めない）
+        input_backlog = bytearray()
+        stdin_paused = False
+
+        def write_input(parts, size):
+            """通常入力（bytes 類の断片）を PTY に送り、書ききれなかった分を input_backlog に溜める"""
+            nonlocal stdin_paused
+            if input_backlog:
+                # 先に溜まっている入力を追い越さないよう、後ろに積む
+                input_backlog.extend(b''.join(parts))
+                return
+            if len(parts) > 64:
+                # writev の断片数の上限（IOV_MAX）を超えないよう結合する
+                parts = [b''.join(parts)]
+            try:
+                written = os.writev(master, parts)
+            except BlockingIOError:
+                written = 0
+            if written < size:
+                input_backlog.extend(b''.join(parts)[written:])
+                selector.modify(master, selectors.EVENT_READ | selectors.EVENT_WRITE)
+                if stdin_fd in selector.get_map():
+                    selector.unregister(stdin_fd)
+                    stdin_paused = True
+
+        def drain_input_backlog():
+            """input_backlog を書けるだけ PTY に送り、送り終えたら stdin の読み取りを再開する"""
+            nonlocal stdin_paused
+            try:
+                written = os.write(master, input_backlog)
+            except BlockingIOError:
+                return
+            del input_backlog[:written]
+            if not input_backlog:
+                selector.modify(master, selectors.EVENT_READ)
+                if stdin_paused:
+                    selector.register(stdin_fd, selectors.EVENT_READ)
+                    stdin_paused = False
+
+        def flush_output(final=False):
+            """送信待ちの PTY 出力を stdout に書き出す。
+
+            Node.js 側は受け取ったチャンクごとに UTF-8 としてデコードするため、
+            末尾で途切れたマルチバイト文字は次の出力と一緒に送る（final のときは全て送る）。
+            """
+            nonlocal output_deadline
+            output_deadline = None
+            if not output_buffer:
+                return
+            end = len(output_buffer) if final else utf8_complete_length(output_buffer)
+            if end == len(output_buffer) or end == 0:
+                # 途切れた文字だけが残っている場合は、待ち続けないようそのまま送る
+                write_all(STDOUT_FD, output_buffer)
+                output_buffer.clear()
+            else:
+                write_all(STDOUT_FD, output_buffer[:end])
+                del output_buffer[:end]
+                output_deadline = time.monotonic() + OUTPUT_FLUSH_INTERVAL
+
+        def apply_resize(rows, cols):
+            """リサイズ指示を反映する。
+            rows, cols は xterm の CSI 8 ; rows ; cols t に対応。
+            """
+            set_winsize(master, rows, cols)
+            # シェルへウィンドウサイズ変更通知（起動済みのシェルは環境変数ではなく
+            # SIGWINCH を受けて TIOCGWINSZ でサイズを読み直す）
+            try:
+                os.killpg(os.getpgid(p.pid), signal.SIGWINCH)
+            except OSError:
+                pass
 
-        # startup commands を実行
-        startup_commands_executed = False
-        startup_delay_time = time.time() + 1.0  # 1秒後に実行
+        # startup commands を実行する時刻（シェル起動から1秒後。実行後は None）
+        startup_deadline = time.monotonic() + 1.0 if startup_payload else None
 
         # メイン I/O ループ
         try:
-            while p.poll() is None:
-                current_time = time.time()
-
-                # startup commands を実行（シェル起動から1秒後）
-                if (
-                    not startup_commands_executed
-                    and current_time >= startup_delay_time
-                    and startup_commands
-                ):
-                    startup_commands_executed = True
-                    for command in startup_commands:
-                        if command.strip():
-                            # コマンドを PTY に送信
-                            command_with_newline = command + '\n'
-                            os.write(
-                                master, command_with_newline.encode('utf-8')
-                            )
-                            time.sleep(0.1)  # コマンド間に少し間隔を空ける
-
-                # CLI エージェントアクティブチェック（3秒間隔で実行）
-                if current_time - last_agent_check >= check_interval:
-                    # Claude や Gemini の検出を実行（負荷軽減のため3秒間隔）
-                    new_agent_state = check_cli_agent_active(p.pid)
+            while pidfd is not None or p.poll() is None:
+                # 期限を迎えた処理と入出力の待機。stdout への書き込みを伴うので、
+                # 閉じられた場合の BrokenPipeError を下の except で扱えるよう try の中で行う
+                try:
+                    # startup commands を実行（シェル起動から1秒後）。
+                    # 一度に書ききれない分は通常入力と同じく input_backlog から送る
                     if (
-                        new_agent_state
-                        and new_agent_state != current_agent_state
+                        startup_deadline is not None
+                        and time.monotonic() >= startup_deadline
                     ):
-                        current_agent_state = new_agent_state
-                        send_status_message(
-                            'cli_agent_status', current_agent_state
-                        )
-
-                    last_agent_check = current_time
-
-                # フォアグラウンドプロセス名チェック（1秒間隔）
-                if current_time - last_fg_process_check >= fg_process_check_interval:
-                    new_fg_process = get_foreground_process_name(p.pid)
-                    if new_fg_process and new_fg_process != current_fg_process:
-                        current_fg_process = new_fg_process
-                        send_status_message(
-                            'foreground_process', {'name': current_fg_process}
-                        )
-                    last_fg_process_check = current_time
-
-                # 標準入力から PTY マスターへの入力を処理
-                try:
-                    read_fds = [master]
-                    if stdin_open:
-                        read_fds.append(sys.stdin)
-                    ready, _, _ = select.select(read_fds, [], [], 1.0)
+                        startup_deadline = None
+                        write_input([startup_payload], len(startup_payload))
 
-                    if stdin_open and sys.stdin in ready:
+                    # まとめ送り待ちの PTY 出力を送信
+                    if (
+                        output_deadline is not None
+                        and time.monotonic() >= output_deadline
+                    ):
+                        flush_output()
+
+                    # 待機のタイムアウト: シェル終了を pidfd か SIGCHLD で検知できるなら、
+                    # 定期的に起きる必要はない（監視スレッドの通知も wake パイプで届く）。
+                    # どちらも使えない場合は1秒ごとに poll() で確認する。
+                    # startup commands とまとめ送りは、それぞれの期限ちょうどに起きる。
+                    timeout = None if pidfd is not None or sigchld_wakeup else 1.0
+                    now = time.monotonic()
+                    for deadline in (startup_deadline, output_deadline):
+                        if deadline is not None:
+                            remaining = max(deadline - now, 0.0)
+                            timeout = remaining if timeout is None else min(timeout, remaining)
+
+                    # 標準入力から PTY マスターへの入力を処理
+                    ready = {key.fd: events for key, events in selector.select(timeout)}
+
+                    if stdin_fd in ready:
                         # Node.js からの入力を読み取り（非ブロッキング）
                         try:
                             # バイナリデータとして読み取り
-                            data = os.read(sys.stdin.fileno(), IO_BUFFER_SIZE)
+                            data = os.read(stdin_fd, INPUT_BUFFER_SIZE)
                             if not data:
-                                # EOF（パイプが閉じられた）。以後 stdin を監視しない。
-                                stdin_open = False
+                                # EOF（パイプが閉じられた）。以後 stdin を監視しない（スピン防止）。
+                                selector.unregister(stdin_fd)
                             else:
-                                # 前回の未完成バイト列と結合
-                                input_buffer += data
-
-                                # UTF-8 incomplete sequence を考慮したデコード
-                                text = ''
-                                try:
-                                    # 全体をデコードしてみる
-                                    text = input_buffer.decode('utf-8')
-                                    # 成功したらバッファをクリア
-                                    input_buffer = b''
-                                except UnicodeDecodeError as e:
-                                    # デコードエラーが発生した場合、完全にデコードできる部分だけを取り出す
-                                    if e.start > 0:
-                                        # エラー開始位置より前は正常にデコードできる
-                                        text = input_buffer[: e.start].decode(
-                                            'utf-8'
-                                        )
-                                        # 未処理部分をバッファに残す
-                                        input_buffer = input_buffer[e.start :]
-                                    else:
-                                        # 先頭からエラーの場合、1文字分進めて再試行（破損データの回避）
-                                        if len(input_buffer) > 1:
-                                            input_buffer = input_buffer[1:]
-                                        text = ''
-
-                                if text:
-                                    #
-                                    # NOTE: WebView 側からの resize 通知は、
-                                    # '\x1b[8;{rows};{cols}t' のエスケープシーケンスとして
-                                    # 本プロセスの stdin に流入する。
-                                    # これがユーザー入力（ペースト）に混在した場合、
-                                    # 先頭一致のみの判定だと後続テキストが破棄され得る。
-                                    # そのため、テキスト中の全シーケンスを検出して処理し、
-                                    # 残余の通常テキストだけを PTY に流す。
-                                    #
-
-                                    # CLI Agent ステータス強制チェック信号を検出し、取り除く
-                                    if '\x00' in text:
-                                        # NULL 文字は取り除いたうえで残余を処理する
-                                        if (
-                                            current_time - last_forced_check
-                                            >= forced_check_cooldown
-                                        ):
-                                            new_agent_state = (
-                                                check_cli_agent_active(p.pid)
-                                            )
-                                            if new_agent_state:
-                                                current_agent_state = (
-                                                    new_agent_state
-                                                )
-                                                send_status_message(
-                                                    'cli_agent_status',
-                                                    current_agent_state,
-                                                )
-                                                last_agent_check = current_time
-                                                last_forced_check = (
-                                                    current_time
-                                                )
-                                        text = text.replace('\x00', '')
-
-                                    # リサイズシーケンスを全て処理し、入力から取り除く
-                                    # パターン: ESC [ 8 ; rows ; cols t
-                                    resize_pattern = re.compile(
-                                        r"\x1b\[8;(\d+);(\d+)t"
-                                    )
-
-                                    def handle_resize_match(m: re.Match[str]):
-                                        """リサイズ指示を反映する。
-                                        rows, cols は xterm の CSI 8 ; rows ; cols t に対応。
-                                        """
-                                        try:
-                                            rows = int(m.group(1))
-                                            cols = int(m.group(2))
-                                        except (ValueError, IndexError):
-                                            return
-                                        set_winsize(master, rows, cols)
-                                        os.environ['LINES'] = str(rows)
-                                        os.environ['COLUMNS'] = str(cols)
-                                        # シェルへウィンドウサイズ変更通知
-                                        if p.pid:
-                                            try:
-                                                os.killpg(
-                                                    os.getpgid(p.pid),
-                                                    signal.SIGWINCH,
-                                                )
-                                            except OSError:
-                                                pass
-
-                                    # テキストから全てのリサイズシーケンスを除去しつつ適用
+                                # 前回の読み取りで途中までしか届かなかったリサイズシーケンスと結合
+                                read_full = len(data) == INPUT_BUFFER_SIZE
+                                data = pending_input + data
+                                pending_input = b''
+                                if read_full:
+                                    # バッファ一杯まで読んだ場合は続きがパイプに残っているので、
+                                    # 末尾で途切れたリサイズシーケンスは次の読み取りまで保留する
+                                    # （ESC キー単体の入力を遅らせないよう、一杯のときだけ判定する）
+                                    m = RESIZE_PREFIX_RE.search(data)
+                                    if m:
+                                        pending_input = data[m.start() :]
+                                        data = data[: m.start()]
+
+                                #
+                                # NOTE: WebView 側からの resize 通知は、
+                                # '\x1b[8;{rows};{cols}t' のエスケープシーケンスとして
+                                # 本プロセスの stdin に流入する。
+                                # これがユーザー入力（ペースト）に混在した場合、
+                                # 先頭一致のみの判定だと後続テキストが破棄され得る。
+                                # そのため、入力中の全シーケンスを検出して処理し、
+                                # 残余の通常入力だけを PTY に流す。
+                                # 検出対象はいずれも ASCII なので、UTF-8 にデコードせず
+                                # バイト列のまま扱う（マルチバイト文字の分割も気にしなくてよい）。
+                                #
+
+                                # CLI Agent ステータス強制チェック信号を検出し、取り除く
+                                if b'\x00' in data:
+                                    # NULL 文字は取り除いたうえで残余を処理する
+                                    now = time.monotonic()
+                                    if now >= next_forced_check:
+                                        # 検出自体は監視スレッドで行う
+                                        force_agent_check.set()
+                                        next_forced_check = now + forced_check_cooldown
+                                    data = data.translate(None, b'\x00')
+
+                                # 入力から全てのリサイズシーケンスを取り除く
+                                # （通常のキー入力にはまず含まれないので、含まれる場合だけ正規表現を使う）。
+                                # 残す通常入力はコピーせず memoryview の断片として保持する
+                                input_parts = [memoryview(data)] if data else []
+                                if b'\x1b[8;' in data:
                                     tail = 0
-                                    cleaned_parts = []
-                                    for m in resize_pattern.finditer(text):
-                                        # マッチ前の通常テキストを溜める
+                                    view = input_parts[0]
+                                    input_parts = []
+                                    last_resize = None
+                                    for m in RESIZE_RE.finditer(data):
+                                        # マッチ前の通常入力を溜める
                                         if m.start() > tail:
-                                            cleaned_parts.append(
-                                                text[tail : m.start()]
-                                            )
-                                        # マッチ処理
-                                        handle_resize_match(m)
+                                            input_parts.append(view[tail : m.start()])
+                                        last_resize = m
                                         tail = m.end()
                                     # 最後の残り
-                                    if tail < len(text):
-                                        cleaned_parts.append(text[tail:])
-                                    cleaned_text = ''.join(cleaned_parts)
-
-                                    # 通常テキストを PTY に送信（大量データは分割して送信）
-                                    if cleaned_text:
-                                        # 大量データ（1KB超）は vim などの対話的アプリのためチャンク分割
-                                        if len(cleaned_text) > 1024:
-                                            # 512バイトずつ分割して送信
-                                            for i in range(
-                                                0, len(cleaned_text), 512
-                                            ):
-                                                chunk = cleaned_text[
-                                                    i : i + 512
-                                                ]
-                                                try:
-                                                    os.write(
-                                                        master,
-                                                        chunk.encode(
-                                                            'utf-8',
-                                                            errors='ignore',
-                                                        ),
-                                                    )
-                                                    # チャンク間に短い遅延（vim の処理時間確保）
-                                                    if i + 512 < len(
-                                                        cleaned_text
-                                                    ):
-                                                        time.sleep(
-                                                            0.01
-                                                        )  # 10ms
-                                                except OSError as e:
-                                                    # EAGAIN などの場合は少し待ってリトライ
-                                                    if e.errno == errno.EAGAIN:
-                                                        time.sleep(0.05)
-                                                        try:
-                                                            os.write(
-                                                                master,
-                                                                chunk.encode(
-                                                                    'utf-8',
-                                                                    errors='ignore',
-                                                                ),
-                                                            )
-                                                        except OSError:
-                                                            # 2回目も失敗したら諦める
-                                                            pass
-                                                    else:
-                                                        # EAGAIN 以外のエラーは再発生させる
-                                                        raise
-                                        else:
-                                            # 小さなデータはそのまま送信
-                                            os.write(
-                                                master,
-                                                cleaned_text.encode(
-                                                    'utf-8', errors='ignore'
-                                                ),
-                                            )
-                                else:
-                                    # デコードされたテキストがない場合は何もしない（バッファに残っている）
-                                    pass
+                                    if tail < len(data):
+                                        input_parts.append(view[tail:])
+                                    # ウィンドウのドラッグ中などに複数届いたリサイズ指示は
+                                    # 最後のものだけを反映し、ioctl と SIGWINCH を1回にまとめる
+                                    if last_resize is not None:
+                                        apply_resize(
+                                            int(last_resize.group(1)),
+                                            int(last_resize.group(2)),
+                                        )
+
+                                # 通常入力を PTY に送信（書ききれない分は PTY が書き込み可能になってから送る）
+                                input_size = sum(len(part) for part in input_parts)
+                                if input_size:
+                                    write_input(input_parts, input_size)
+                                    echo_pending = True
                         except OSError as e:
                             # EAGAIN は未準備、EIO/ENXIO などは実質クローズとみなす
-                            if e.errno in (errno.EIO, errno.ENXIO):
-                                stdin_open = False
+                            if e.errno in (errno.EIO, errno.ENXIO) and (
+                                stdin_fd in selector.get_map()
+                            ):
+                                selector.unregister(stdin_fd)
                             # その他は無視
                             pass
 
-                    if master in ready:
-                        # PTY からの出力を読み取り
+                    if input_backlog and ready.get(master, 0) & selectors.EVENT_WRITE:
+                        # 溜まっている入力を PTY に送る
+                        drain_input_backlog()
+                        echo_pending = True
+
+                    if ready.get(master, 0) & selectors.EVENT_READ:
+                        # PTY からの出力を EAGAIN になるまでまとめて読み取り、送信待ちバッファに溜める
+                        drained = 0
+                        pty_closed = False
+                        while drained < PTY_DRAIN_LIMIT:
+                            try:
+                                data = os.read(master, IO_BUFFER_SIZE)
+                            except OSError as e:
+                                # EAGAIN は PTY バッファが空になったということ
+                                if e.errno in (errno.EIO, errno.ENXIO):
+                                    # PTY が閉じられた場合はループを抜ける
+                                    pty_closed = True
+                                # その他のエラーも基本的に無視（安定性向上）
+                                break
+                            if not data:
+                                break
+                            drained += len(data)
+                            # フロントエンドは UTF-8 のバイト列をそのまま扱えるので、デコードせずに転送する
+                            output_buffer += data
+
+                        if pty_closed:
+                            break
+                        if output_buffer:
+                            # 入力直後のエコーと大量出力はすぐに送り、それ以外は
+                            # OUTPUT_FLUSH_INTERVAL の間に届いた出力をまとめて送る
+                            if echo_pending or len(output_buffer) >= OUTPUT_FLUSH_THRESHOLD:
+                                echo_pending = False
+                                flush_output()
+                            elif output_deadline is None:
+                                output_deadline = time.monotonic() + OUTPUT_FLUSH_INTERVAL
+
+                    if wake_r in ready:
+                        # 監視スレッドからのステータスを送信（SIGCHLD による起床もここで読み捨てる）
                         try:
-                            data = os.read(master, IO_BUFFER_SIZE)
-                            if data:
-                                # UTF-8 でデコードしてから再エンコード（文字化け対策）
-                                try:
-                                    decoded_text = data.decode(
-                                        'utf-8', errors='ignore'
-                                    )
-                                    encoded_data = decoded_text.encode('utf-8')
-                                    sys.stdout.buffer.write(encoded_data)
-                                    sys.stdout.buffer.flush()
-                                except (
-                                    UnicodeDecodeError,
-                                    UnicodeEncodeError,
-                                ):
-                                    # エラー時はバイナリデータをそのまま送信
-                                    sys.stdout.buffer.write(data)
-                                    sys.stdout.buffer.flush()
-                        except OSError as e:
-                            # EAGAIN は PTY バッファが空なので無視
-                            if e.errno == errno.EAGAIN:
+                            while os.read(wake_r, IO_BUFFER_SIZE):
                                 pass
-                            elif e.errno in (errno.EIO, errno.ENXIO):
-                                # PTY が閉じられた場合はループを抜ける
+                        except BlockingIOError:
+                            pass
+                        # 途中までの出力やマルチバイト文字の間にステータスが割り込まないよう、先に送っておく
+                        flush_output()
+                        messages = []
+                        while True:
+                            try:
+                                messages.append(status_queue.get_nowait())
+                            except queue.Empty:
                                 break
-                            # その他のエラーも基本的に無視（安定性向上）
+                        if messages:
+                            write_all(STDOUT_FD, b''.join(messages))
+
+                    if pidfd is not None and pidfd in ready:
+                        # シェルが終了した
+                        break
 
-                except (select.error, OSError):
-                    time.sleep(0.1)  # CPU 負荷軽減のため少し長めに待機
+                except BrokenPipeError:
+                    # stdout（Node.js 側）が閉じられたので転送先がない
+                    break
+                except OSError:
+                    # 割り込みなどの一時的なエラーはそのまま次の待機に戻る
+                    # （EINTR では select 自体が再試行されるので待機を挟む必要はない）
+                    continue
 
         except KeyboardInterrupt:
             break  # Ctrl+C でループを抜ける
         finally:
+            # 送信待ちの PTY 出力を書き出す
+            try:
+                flush_output(final=True)
+            except (OSError, BufferError):
+                pass
+
+            # 監視スレッドを止めてから wake パイプを閉じる
+            stop_monitor.set()
+            force_agent_check.set()
+            monitor_thread.join(timeout=2)
+            if sigchld_wakeup:
+                signal.set_wakeup_fd(-1)
+            selector.close()
+            os.close(wake_r)
+            os.close(wake_w)
+            if pidfd is not None:
+                os.close(pidfd)
+
             # PTY を閉じる
             try:
                 if current_master:
@@ -713,10 +1046,11 @@ def main():
 
         # シェルが終了した場合、スクリプトも終了（タブを閉じる処理はNode.js側で行う）
         if p.poll() is not None:
-            sys.stdout.buffer.write(
-                b'\r\n[Shell terminated.]\r\n'
-            )
-            sys.stdout.buffer.flush()
+            try:
+                write_all(STDOUT_FD, b'\r\n[Shell terminated.]\r\n')
+            except OSError:
+                # stdout が既に閉じられている
+                pass
         break  # ループを抜けてスクリプト終了
 
 